@@ -1,13 +1,20 @@
 from __future__ import annotations
 
 import json
-from collections.abc import Mapping
+import os
+from collections.abc import Mapping, Sequence
 from dataclasses import dataclass
 from enum import StrEnum
 from pathlib import Path
 from typing import Any
 
+from anki.collection import Collection, OpChanges, SearchNode
+from anki.errors import Interrupted, InvalidInput, SearchError
+from anki.models import NotetypeDict
+from anki.notes import NoteId
+from anki.utils import ids2str
 from aqt import gui_hooks, mw
+from aqt.operations import CollectionOp
 from aqt.qt import (
     QAction,
     QComboBox,
@@ -75,24 +82,49 @@ class Config:
         }
 
 
+_config_cache: tuple[tuple[int, int], Config] | None = None
+
+
 def load_config() -> Config:
-    if CONFIG_PATH.exists():
-        try:
-            with CONFIG_PATH.open('r', encoding='utf-8') as handle:
-                raw = json.load(handle)
-            if isinstance(raw, Mapping):
-                return Config.from_mapping(raw)
-        except (OSError, ValueError, TypeError) as err:
-            tooltip(f'Field Matcher: using defaults because config is invalid ({err}).')
+    global _config_cache
+
+    try:
+        stat = CONFIG_PATH.stat()
+    except FileNotFoundError:
+        return Config()
+    except OSError as err:
+        tooltip(f'Field Matcher: using defaults because config is invalid ({err}).')
+        return Config()
+
+    cache_key = (stat.st_mtime_ns, stat.st_size)
+    if _config_cache is not None and _config_cache[0] == cache_key:
+        return _config_cache[1]
+
+    try:
+        with CONFIG_PATH.open('r', encoding='utf-8') as handle:
+            raw = json.load(handle)
+        if isinstance(raw, Mapping):
+            config = Config.from_mapping(raw)
+            _config_cache = (cache_key, config)
+            return config
+    except (OSError, ValueError, TypeError) as err:
+        tooltip(f'Field Matcher: using defaults because config is invalid ({err}).')
     return Config()
 
 
 def save_config(config: Config) -> None:
+    global _config_cache
+
+    _config_cache = None
+    tmp_path = CONFIG_PATH.with_suffix('.json.tmp')
     try:
-        with CONFIG_PATH.open('w', encoding='utf-8') as handle:
-            json.dump(config.to_mapping(), handle, indent=2)
-            handle.write('\n')
+        with tmp_path.open('w', encoding='utf-8') as handle:
+            json.dump(config.to_mapping(), handle, separators=(',', ':'))
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(tmp_path, CONFIG_PATH)
     except OSError as err:
+        tmp_path.unlink(missing_ok=True)
         showInfo(f'Field Matcher: failed to save config ({err}).')
 
 
@@ -110,17 +142,36 @@ def anki_field_matcher() -> None:
         showInfo('Both field names must be provided.')
         return
 
+    if updated_config.field1_name == updated_config.field2_name:
+        showInfo('Field names must be different.')
+        return
+
     if not updated_config.tag_name:
         showInfo('Tag must be provided.')
         return
 
+    try:
+        note_ids = mw.col.find_notes(build_search(updated_config))
+    except (InvalidInput, SearchError) as err:
+        showInfo(f'Invalid filter: {err}')
+        return
+
     save_config(updated_config)
 
-    tagged_count, skipped_count = tag_matching_notes(updated_config)
+    CollectionOp(
+        parent=mw,
+        op=lambda col: tag_matching_notes(col, updated_config, note_ids),
+    ).success(
+        lambda result: show_result(updated_config, result),
+    ).with_progress(
+        'Matching fields...',
+    ).run_in_background()
 
-    message = f"Tagged {tagged_count} cards with '{updated_config.tag_name}' tag."
-    if skipped_count:
-        message += f'\nSkipped {skipped_count} notes without the specified fields.'
+
+def show_result(config: Config, result: MatchResult) -> None:
+    message = f"Tagged {result.tagged_count} cards with '{config.tag_name}' tag."
+    if result.skipped_count:
+        message += f'\nSkipped {result.skipped_count} notes without the specified fields.'
     showInfo(message)
 
 
@@ -165,14 +216,18 @@ def request_config_from_user(config: Config) -> Config | None:
     match_mode = MatchMode(current_mode) if current_mode else MatchMode.UNEQUAL
 
     return Config(
-        field1_name=field1_input.text().strip(),
-        field2_name=field2_input.text().strip(),
-        filter=filter_input.text().strip(),
+        field1_name=_input_text(field1_input),
+        field2_name=_input_text(field2_input),
+        filter=_input_text(filter_input),
         match_mode=match_mode,
-        tag_name=tag_input.text().strip(),
+        tag_name=_input_text(tag_input),
     )
 
 
+def _input_text(line_edit: QLineEdit) -> str:
+    return line_edit.text().strip()
+
+
 def _build_match_mode_combo(parent: QWidget, current: MatchMode) -> QComboBox:
     combo = QComboBox(parent)
     for mode in MatchMode:
@@ -182,34 +237,142 @@ def _build_match_mode_combo(parent: QWidget, current: MatchMode) -> QComboBox:
     return combo
 
 
-def tag_matching_notes(config: Config) -> tuple[int, int]:
-    tagged_count = 0
-    skipped_count = 0
+def build_search(config: Config) -> str:
+    notetype_nodes = [
+        SearchNode(note=notetype['name'])
+        for notetype in mw.col.models.all()
+        if _find_field_ords(notetype, config.field1_name, config.field2_name) is not None
+    ]
+    if not notetype_nodes:
+        # Nothing can match; keep the plain filter so every found note is reported as skipped.
+        return config.filter
 
-    for note_id in mw.col.find_notes(config.filter):
-        note = mw.col.get_note(note_id)
-        note_type = note.note_type()
-        field_names = {field['name'] for field in note_type['flds']}
+    notetypes = mw.col.group_searches(*notetype_nodes, joiner='OR')
+    if not config.filter:
+        return mw.col.build_search_string(notetypes)
+    return mw.col.build_search_string(config.filter, notetypes)
 
-        if config.field1_name not in field_names or config.field2_name not in field_names:
-            skipped_count += 1
-            continue
 
-        field1_value = note[config.field1_name].strip()
-        field2_value = note[config.field2_name].strip()
+@dataclass
+class MatchResult:
+    changes: OpChanges
+    tagged_count: int = 0
+    skipped_count: int = 0
+
+
+_PROGRESS_STEP = 500
+
+
+def tag_matching_notes(col: Collection, config: Config, note_ids: Sequence[NoteId]) -> MatchResult:
+    if not note_ids:
+        return MatchResult(OpChanges())
+
+    note_ids_sql = ids2str(note_ids)
+
+    field_ords: dict[int, tuple[int, int]] = {}
+    for notetype_id in col.db.list('select distinct mid from notes where id in ' + note_ids_sql):
+        ords = _find_field_ords(col.models.get(notetype_id), config.field1_name, config.field2_name)
+        if ords is not None:
+            field_ords[notetype_id] = ords
 
-        should_tag = (
-            bool(field1_value) and field1_value == field2_value
-            if config.match_mode is MatchMode.EQUAL
-            else field1_value != field2_value
+    if not field_ords:
+        return MatchResult(OpChanges(), skipped_count=len(note_ids))
+
+    total_count = col.db.scalar(
+        f'select count() from notes where id in {note_ids_sql} and mid in {ids2str(field_ords)}'
+    )
+    skipped_count = len(note_ids) - total_count
+
+    # The tags column is stored space-padded, e.g. ' tag1 tag2 '.
+    padded_tag = f' {config.tag_name} '
+    find_ids = _find_equal_note_ids if config.match_mode is MatchMode.EQUAL else _find_unequal_note_ids
+
+    matching_ids: list[NoteId] = []
+    scanned_count = 0
+    for notetype_id, (field1_ord, field2_ord) in field_ords.items():
+        rows = col.db.all(
+            f'select id, tags, flds from notes where id in {note_ids_sql} and mid = ?', notetype_id
         )
+        for start in range(0, len(rows), _PROGRESS_STEP):
+            chunk = rows[start : start + _PROGRESS_STEP]
+            matching_ids += find_ids(chunk, field1_ord, field2_ord, padded_tag)
+            scanned_count += len(chunk)
+            _report_progress(scanned_count, total_count)
 
-        if should_tag and config.tag_name not in note.tags:
-            note.tags.append(config.tag_name)
-            note.flush()
-            tagged_count += 1
+    if not matching_ids:
+        return MatchResult(OpChanges(), skipped_count=skipped_count)
 
-    return tagged_count, skipped_count
+    changes = col.tags.bulk_add(matching_ids, config.tag_name)
+    return MatchResult(changes.changes, changes.count, skipped_count)
+
+
+def _report_progress(done: int, total: int) -> None:
+    # Runs on the background thread; nothing has been written yet, so aborting is safe.
+    if mw.progress.want_cancel():
+        raise Interrupted()
+    mw.taskman.run_on_main(
+        lambda: mw.progress.update(label=f'Scanned {done}/{total} notes', value=done, max=total)
+    )
+
+
+_NoteRow = tuple[NoteId, str, str]
+
+
+def _find_equal_note_ids(
+    rows: Sequence[_NoteRow], field1_ord: int, field2_ord: int, padded_tag: str
+) -> list[NoteId]:
+    maxsplit = max(field1_ord, field2_ord) + 1
+    matching_ids: list[NoteId] = []
+    for note_id, tags, fields in rows:
+        if padded_tag in tags:
+            continue
+
+        values = fields.split('\x1f', maxsplit)
+        field1_value = values[field1_ord]
+        field2_value = values[field2_ord]
+
+        # str == already bails out on length or first differing character, and strip() returns
+        # the same object when there is nothing to remove, so unequal values are cheap here.
+        if field1_value != field2_value:
+            field1_value = field1_value.strip()
+            if field1_value != field2_value.strip():
+                continue
+
+        if field1_value and not field1_value.isspace():
+            matching_ids.append(note_id)
+    return matching_ids
+
+
+def _find_unequal_note_ids(
+    rows: Sequence[_NoteRow], field1_ord: int, field2_ord: int, padded_tag: str
+) -> list[NoteId]:
+    maxsplit = max(field1_ord, field2_ord) + 1
+    matching_ids: list[NoteId] = []
+    for note_id, tags, fields in rows:
+        if padded_tag in tags:
+            continue
+
+        values = fields.split('\x1f', maxsplit)
+        field1_value = values[field1_ord]
+        field2_value = values[field2_ord]
+
+        if field1_value != field2_value and field1_value.strip() != field2_value.strip():
+            matching_ids.append(note_id)
+    return matching_ids
+
+
+def _find_field_ords(
+    notetype: NotetypeDict | None, field1_name: str, field2_name: str
+) -> tuple[int, int] | None:
+    if notetype is None:
+        return None
+
+    ords_by_name = {field['name']: field['ord'] for field in notetype['flds']}
+    field1_ord = ords_by_name.get(field1_name)
+    field2_ord = ords_by_name.get(field2_name)
+    if field1_ord is None or field2_ord is None:
+        return None
+    return field1_ord, field2_ord
 
 
 _ACTION_LABEL = 'Match (Un)equal Fields'
@@ -219,6 +382,9 @@ _action: QAction | None = None
 def add_to_menu() -> None:
     global _action
 
+    if _action is not None:
+        return
+
     if not getattr(mw, 'form', None):
         return
 
@@ -226,23 +392,9 @@ def add_to_menu() -> None:
     if menu is None:
         return
 
-    if _action and _action in menu.actions():
-        menu.removeAction(_action)
-        _action.deleteLater()
-        _action = None
-    else:
-        for existing in menu.actions():
-            if existing.text() == _ACTION_LABEL:
-                menu.removeAction(existing)
-                existing.deleteLater()
-                break
-
     _action = QAction(_ACTION_LABEL, mw)
     _action.triggered.connect(anki_field_matcher)
     menu.addAction(_action)
 
 
 gui_hooks.main_window_did_init.append(add_to_menu)
-
-if getattr(mw, 'form', None):
-    add_to_menu()